@@ -6,11 +6,12 @@ MSVE projects are stored in SQLite database found in this path:
 More about EDL format here: https://www.niwa.nu/2013/05/how-to-read-an-edl/
 
 Usage:
-Scroll to the very bottom and replace the project name you would like to export and output file path
-then just run it.
+Run it without arguments to pick an album and output file interactively, or pass one or more
+"-e ALBUM TARGET" pairs to export several albums in parallel without prompts.
 
 Limitations: only supports cut-type clips (no transitions or special effects)
 """
+import argparse
 import os
 import typing
 
@@ -38,8 +39,27 @@ def select_project(albums: typing.List[str]) -> str:
     return albums[selection - 1]
 
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Converts Microsoft Photos video albums to EDL files"
+    )
+    parser.add_argument(
+        "-e",
+        "--export",
+        nargs=2,
+        action="append",
+        metavar=("ALBUM", "TARGET"),
+        help="export ALBUM into TARGET file, repeat to export several albums in parallel",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    db = MsPhotosDb()
-    album = select_project(db.get_projects())
-    location = select_location()
-    db.export_edl(album, location)
+    args = parse_args()
+    with MsPhotosDb() as db:
+        if args.export:
+            db.export_edls(args.export)
+        else:
+            album = select_project(db.get_projects())
+            location = select_location()
+            db.export_edl(album, location)
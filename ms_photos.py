@@ -1,18 +1,149 @@
+import concurrent.futures
+import contextlib
 import json
 import os
+import queue
+import re
 import sqlite3
+import threading
 import typing
-from datetime import timedelta
-from math import modf
 
 DB_FILE_PATH = os.path.expandvars(
     r"%LocalAppData%\Packages\Microsoft.PhotosLegacy_8wekyb3d8bbwe\LocalState\MediaDb.v1.sqlite"
 )
 
+# one EDL event per card, same cut on video and audio tracks, format is like this:
+# 001  AX       V     C        00:24:05:25 00:28:34:15 00:00:00:01 00:04:28:20
+EDL_CARD_TEMPLATE = (
+    "\n{index}  AX  V  C  {source_in} {source_out} {master_in} {master_out}"
+    "\n{index}  AX  A  C  {source_in} {source_out} {master_in} {master_out}"
+    "\n* FROM CLIP NAME: {source_path}\n"
+)
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def _iter_json_array(text: str) -> typing.Iterator:
+    """
+    Decode JSON array one element at a time, so only the current element is alive
+    instead of the whole decoded list
+    :param text: JSON array string
+    :return: iterator over decoded elements
+    """
+    decoder = json.JSONDecoder()
+    pos = _JSON_WHITESPACE.match(text, 0).end()
+    if not text.startswith("[", pos):
+        raise ValueError(f"Expected JSON array at position {pos}")
+
+    pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+    if text.startswith("]", pos):
+        return
+
+    while True:
+        item, pos = decoder.raw_decode(text, pos)
+        yield item
+
+        pos = _JSON_WHITESPACE.match(text, pos).end()
+        if text.startswith(",", pos):
+            pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+        elif text.startswith("]", pos):
+            return
+        else:
+            raise ValueError(f"Expected ',' or ']' at position {pos}")
+
 
 class MsPhotosDb:
-    def __init__(self, frame_rate=30):
+    def __init__(self, frame_rate=30, pool_size=4):
         self.frame_rate = frame_rate
+        self.pool_size = pool_size
+        # database is only read, so a few connections let batch exports query it concurrently.
+        # They are opened on demand, a single export never opens more than one
+        self._pool = queue.Queue()
+        self._opened = 0
+        self._closed = False
+        self._lock = threading.Lock()  # guards the three fields above
+
+    @staticmethod
+    def _connect() -> sqlite3.Connection:
+        con = sqlite3.connect(
+            f"file:{DB_FILE_PATH}?mode=ro", uri=True, check_same_thread=False
+        )
+        try:
+            # database belongs to Photos app, so only tune the read side of our own connection
+            con.executescript(
+                """
+                PRAGMA cache_size=-64000;
+                PRAGMA temp_store=MEMORY;
+                PRAGMA mmap_size=268435456;
+                """
+            )
+        except Exception:
+            con.close()
+            raise
+        return con
+
+    def _acquire(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+            try:
+                return self._pool.get_nowait()
+            except queue.Empty:
+                pass
+            if self._opened < self.pool_size:
+                con = MsPhotosDb._connect()
+                self._opened += 1
+                return con
+
+        # every connection is borrowed, wait for one to be given back
+        con = self._pool.get()
+        if con is None:
+            self._pool.put(None)  # pass the closed marker on to other waiting threads
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return con
+
+    def _release(self, con: sqlite3.Connection) -> None:
+        with self._lock:
+            if not self._closed:
+                self._pool.put(con)
+                return
+        con.close()  # borrowed while closing, so it missed the drain in close()
+
+    @contextlib.contextmanager
+    def _connection(self) -> typing.Iterator[sqlite3.Connection]:
+        """
+        Borrow a connection from the pool, opens a new one while under pool_size,
+        otherwise waits for one to be given back
+        """
+        con = self._acquire()
+        try:
+            yield con
+        finally:
+            self._release(con)
+
+    def close(self) -> None:
+        """
+        Close pooled connections, ones still borrowed are closed when given back.
+        Safe to call more than once
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            while True:
+                try:
+                    con = self._pool.get_nowait()
+                except queue.Empty:
+                    break
+                con.close()
+            # wakes up and fails anyone still waiting for a connection
+            self._pool.put(None)
+
+    def __enter__(self) -> "MsPhotosDb":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
     def _nano100_to_time(self, nanos: int) -> str:
         """
@@ -22,99 +153,135 @@ class MsPhotosDb:
         :return: string in EDL representation
         """
         ns = 10000000  # it is stored in 100ns
-        ret = str(timedelta(seconds=nanos // ns))
-        if len(ret) < 8:
-            ret = f"0{ret}"  # append extra 0 if needed
-
-        frame = int(self.frame_rate * modf(nanos / ns)[0])
-        return f"{ret}:{frame:02}"
+        seconds, ticks = divmod(nanos, ns)
+        hours, seconds = divmod(seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        frame = ticks * self.frame_rate // ns
+        return f"{hours:02}:{minutes:02}:{seconds:02}:{frame:02}"
 
     def _convert(
-        self, project_name: str, project_data: typing.Dict, target: str
+        self, project_name: str, cards: typing.Iterable[typing.Dict], target: str
     ) -> None:
         """
-        Given MSVE data, converts and saves into target file
+        Given MSVE cards, converts and saves into target file. Cards are consumed one at a time
+        and written out immediately, so any iterable (e.g. a generator) works
         :param project_name: Name of the project
-        :param project_data: Raw data in MSVE format
+        :param cards: Raw cards (clips) in MSVE format
         :param target: Target file path
         """
-        lines = [f"TITLE: {project_name}", "FCM: NON-DROP FRAME", ""]
-
-        index = 1
+        to_time = self._nano100_to_time
         master_time = self.frame_rate
+        master_in = to_time(master_time)
 
-        for card in project_data["Project"]["Cards"]:
-            source_path = card["Sources"][0]["MediaBackedSourceProperties"][
-                "url"
-            ]  # full path to source file
-            start_time_raw = card["Sources"][0]["VideoSourceProperties"][
-                "idealAssetStartTime"
-            ]  # start time in 100 ns
-            duration_raw = card["idealDuration"]  # duration in 100 ns
-
-            # format is like this:
-            # 001  AX       V     C        00:24:05:25 00:28:34:15 00:00:00:01 00:04:28:20
-            times = f"{self._nano100_to_time(start_time_raw)} {self._nano100_to_time(start_time_raw + duration_raw)} {self._nano100_to_time(master_time)} {self._nano100_to_time(master_time + duration_raw)}"
-            lines.append(f"{index:03}  AX  V  C  {times}")  # video track
-            lines.append(f"{index:03}  AX  A  C  {times}")  # audio track
+        with open(target, "w", encoding="utf-8") as f:
+            f.write(f"TITLE: {project_name}\nFCM: NON-DROP FRAME\n")
 
-            lines.append(f"* FROM CLIP NAME: {source_path}")
-            lines.append("")
+            for index, card in enumerate(cards, start=1):
+                source = card["Sources"][0]
+                start_time_raw = source["VideoSourceProperties"][
+                    "idealAssetStartTime"
+                ]  # start time in 100 ns
+                duration_raw = card["idealDuration"]  # duration in 100 ns
 
-            index += 1
-            master_time += duration_raw
+                # clips follow each other on master track, so out point of one clip is in point
+                # of the next
+                master_time += duration_raw
+                master_out = to_time(master_time)
+                f.write(
+                    EDL_CARD_TEMPLATE.format(
+                        index=f"{index:03}",  # formatted once, used by both tracks
+                        source_in=to_time(start_time_raw),
+                        source_out=to_time(start_time_raw + duration_raw),
+                        master_in=master_in,
+                        master_out=master_out,
+                        source_path=source["MediaBackedSourceProperties"][
+                            "url"
+                        ],  # full path to source file
+                    )
+                )
+                master_in = master_out
 
-        with open(target, "w", encoding="utf-8") as f:
-            f.write("\n".join(lines))
+    def get_projects(self) -> typing.List[str]:
+        # Album_Name is declared with the app's NoCaseLinguistic collation; overriding it with
+        # the built-in NOCASE keeps SQLite from calling back into Python on every comparison
+        sql = """
+        select
+            a.Album_Name
+        from Album a
+        order by a.Album_Name collate nocase
+        """
+        with self._connection() as con:
+            # set on the cursor, not the connection, as pooled connections are shared by queries
+            cur = con.cursor()
+            cur.row_factory = lambda _, row: row[0]
+            return list(cur.execute(sql))
 
-    @staticmethod
-    def __collate_nocase(s1: str, s2: str):
+    def _find_album_name(self, project_name: str) -> str:
         """
-        MSVE uses custom collation, so we provide it something similar - case-insensitive collation
+        Find album as it is stored in database. Built-in NOCASE only folds ASCII, so the
+        case-insensitive match is done here to keep names like "été" finding "Été"
+        :param project_name: Name of the album in any case
+        :return: stored name of the album
         """
-        if s1.lower() == s2.lower():
-            return 0
-        elif s1.lower() < s2.lower():
-            return 1
-        else:
-            return -1
-
-    def get_projects(self) -> typing.List[str]:
-        with sqlite3.connect(f"file:{DB_FILE_PATH}?mode=ro", uri=True) as con:
-            con.create_collation("NoCaseLinguistic", MsPhotosDb.__collate_nocase)
-            sql = """
-            select
-                a.Album_Name
-            from Album a
-            order by a.Album_Name
-            """
-            cur = con.cursor()
-            cur.execute(sql)
-            albums = cur.fetchall()
-            cur.close()
+        albums = self.get_projects()
+        if project_name in albums:
+            return project_name
 
-            return [row[0] for row in albums]
+        folded = project_name.casefold()
+        for album in albums:
+            if album.casefold() == folded:
+                return album
 
-    def export_edl(self, project_name: str, target: str):
-        with sqlite3.connect(f"file:{DB_FILE_PATH}?mode=ro", uri=True) as con:
-            con.create_collation("NoCaseLinguistic", MsPhotosDb.__collate_nocase)
+        raise Exception(f"Project not found in database: {project_name}")
 
-            sql = """
+    def get_project_cards(self, project_name: str) -> str:
+        """
+        Fetch only the cards (clips) of the given album. SQLite's JSON1 functions unwrap the
+        project state inside the database, so just the cards array crosses over to Python
+        :param project_name: Name of the album
+        :return: cards as JSON array string
+        """
+        sql = """
         select 
-            p.Project_RpmState
+            json_extract(
+                json_extract(p.Project_RpmState, '$.RenderableProjectManagerBlob'),
+                '$.Project.Cards'
+            )
         from Project p
             inner join Album a on p.Project_AlbumId=a.Album_Id
-        where a.Album_Name=?
+        where a.Album_Name=? collate binary
         """
-            cur = con.cursor()
-            cur.execute(sql, [project_name])
+        with self._connection() as con:
+            project = con.execute(sql, [self._find_album_name(project_name)]).fetchone()
+        if project is None:
+            raise Exception(f"Project not found in database: {project_name}")
+        if project[0] is None:
+            raise Exception(f"Project has no clips: {project_name}")
 
-            project = cur.fetchone()
-            if project is None:
-                raise Exception(f"Project not found in database: {project_name}")
+        return project[0]
 
-            project_data = json.loads(
-                json.loads(project[0])["RenderableProjectManagerBlob"]
-            )
+    def _iter_cards(self, project_name: str) -> typing.Iterator[typing.Dict]:
+        """
+        Fetch MSVE project cards and decode them lazily, one card at a time
+        :param project_name: Name of the album
+        :return: iterator over decoded project cards
+        """
+        return _iter_json_array(self.get_project_cards(project_name))
+
+    def export_edl(self, project_name: str, target: str):
+        self._convert(project_name, self._iter_cards(project_name), target)
 
-        self._convert(project_name, project_data, target)
+    def export_edls(self, exports: typing.Iterable[typing.Tuple[str, str]]) -> None:
+        """
+        Export several projects in parallel, one pooled connection per worker
+        :param exports: pairs of project name and target file path
+        """
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.pool_size
+        ) as executor:
+            futures = [
+                executor.submit(self.export_edl, project_name, target)
+                for project_name, target in exports
+            ]
+            for future in futures:
+                future.result()